@@ -1,8 +1,15 @@
-from flask import Flask, jsonify, render_template_string
+from flask import Flask, Response, jsonify, render_template_string, request
 from flask_cors import CORS
-import requests
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timezone
+import gzip
+import importlib.util
 import json
+import math
+import os
+import tempfile
+import threading
+import time
 
 app = Flask(__name__)
 CORS(app)
@@ -14,30 +21,328 @@ EARTHQUAKE_API = "https://api.p2pquake.net/v2/history?codes=551&limit=20"
 def index():
     return render_template_string(HTML_TEMPLATE)
 
+# 取得した地震情報を使い回す期間（秒）
+SNAPSHOT_TTL = 60
+
+# これより古い地震情報は返さず、取得できなければエラーにする（秒）
+SNAPSHOT_MAX_AGE = 30 * 60
+
+# 取得に失敗した後、再び取得を試みるまでの間隔（秒）
+FETCH_RETRY_INTERVAL = 10
+
+# 再起動後すぐに返せるよう、最後に取得した地震情報を保存しておく場所
+SNAPSHOT_PATH = os.environ.get(
+    'SNAPSHOT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'earthquakes_snapshot.json'))
+
+# ?fields= で指定できる項目と ?limit= の上限
+EARTHQUAKE_FIELDS = ('id', 'time', 'hypocenter', 'magnitude', 'depth', 'maxScale', 'domesticTsunami')
+MAX_LIMIT = 20
+
+# これより小さいレスポンスは圧縮しない（バイト）
+COMPRESS_MIN_SIZE = 512
+
+# エンコード済みレスポンスを保持する最大件数
+RESPONSE_CACHE_SIZE = 32
+
+# 圧縮ライブラリは起動を速くするため、初めて使うときに import する
+def compress_zstd(body):
+    import zstandard
+    return zstandard.ZstdCompressor(level=10).compress(body)
+
+def compress_brotli(body):
+    import brotli
+    return brotli.compress(body, quality=9)
+
+# ヘルスチェック用のパス（最初のレスポンスの計測から外す）
+PROBE_PATHS = ('/healthz', '/readyz')
+
+def process_started_at():
+    # インタプリタの起動も含めるため、/proc からプロセスの起動時刻を求める
+    try:
+        with open('/proc/self/stat') as f:
+            # プロセス名に空白が入ることがあるので ')' より後ろを使う
+            stat = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        started = int(stat[19]) / os.sysconf('SC_CLK_TCK')
+        return time.monotonic() - (uptime - started)
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+PROCESS_STARTED_AT = process_started_at()
+
+# 利用できる圧縮方式（優先度の高い順）
+COMPRESSORS = {}
+if importlib.util.find_spec('zstandard') is not None:
+    COMPRESSORS['zstd'] = compress_zstd
+if importlib.util.find_spec('brotli') is not None:
+    COMPRESSORS['br'] = compress_brotli
+COMPRESSORS['gzip'] = lambda body: gzip.compress(body, compresslevel=6, mtime=0)
+
+_snapshot = {'version': 0, 'fetched_at': 0.0, 'data': None}
+_snapshot_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+
+# 直近の取得失敗（時刻とエラー内容）。待っていたリクエストはこれを使い回す
+_last_failure = None
+
+# プロセスの起動から、ヘルスチェック以外への最初のレスポンスまでの時間（秒）
+_first_response_seconds = None
+_refresh_scheduled = False
+
+# (スナップショット版, fields, limit, 圧縮方式) -> エンコード済みレスポンス
+# よく使われる組み合わせだけが残るよう、古いものから捨てる
+_response_cache = OrderedDict()
+
+def fetch_earthquakes():
+    # requests は import が重いので、起動時ではなく初回取得時に読み込む
+    import requests
+    response = requests.get(EARTHQUAKE_API, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    
+    earthquakes = []
+    for item in data:
+        if item.get('code') == 551:  # 地震情報
+            eq_data = item.get('earthquake', {})
+            earthquakes.append({
+                'id': item.get('id'),
+                'time': eq_data.get('time'),
+                'hypocenter': eq_data.get('hypocenter', {}).get('name', '不明'),
+                'magnitude': eq_data.get('hypocenter', {}).get('magnitude', 0),
+                'depth': eq_data.get('hypocenter', {}).get('depth', 0),
+                'maxScale': eq_data.get('maxScale', 0),
+                'domesticTsunami': eq_data.get('domesticTsunami', 'Unknown')
+            })
+    return earthquakes
+
+def set_snapshot(earthquakes, fetched_at):
+    with _snapshot_lock:
+        _snapshot['version'] += 1
+        _snapshot['fetched_at'] = fetched_at
+        _snapshot['data'] = earthquakes
+        # 古いスナップショットのエンコード結果は不要
+        _response_cache.clear()
+
+def snapshot_age():
+    with _snapshot_lock:
+        if _snapshot['data'] is None:
+            return None
+        return time.time() - _snapshot['fetched_at']
+
+def is_fresh(age, max_age):
+    # 時計が巻き戻って負になった場合も古いものとして扱う
+    return age is not None and 0 <= age <= max_age
+
+def save_snapshot(earthquakes, fetched_at):
+    # 複数のプロセスが同時に書いても壊れないよう、一時ファイル名は毎回変える
+    directory, name = os.path.split(SNAPSHOT_PATH)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, prefix=name + '.',
+                                     suffix='.tmp', delete=False) as f:
+        json.dump({'fetched_at': fetched_at, 'data': earthquakes}, f, ensure_ascii=False)
+    try:
+        os.replace(f.name, SNAPSHOT_PATH)
+    except OSError:
+        os.unlink(f.name)
+        raise
+
+def is_valid_snapshot(saved):
+    if not isinstance(saved, dict):
+        return False
+    fetched_at = saved.get('fetched_at')
+    if isinstance(fetched_at, bool) or not isinstance(fetched_at, (int, float)):
+        return False
+    # NaN や未来の時刻では鮮度を判断できない
+    if not math.isfinite(fetched_at) or fetched_at > time.time():
+        return False
+    data = saved.get('data')
+    return isinstance(data, list) and all(
+        isinstance(eq, dict) and all(name in eq for name in EARTHQUAKE_FIELDS) for eq in data)
+
+def load_snapshot():
+    try:
+        with open(SNAPSHOT_PATH, encoding='utf-8') as f:
+            saved = json.load(f)
+    except (OSError, ValueError) as e:
+        app.logger.info('保存済みの地震情報を読み込めませんでした: %s', e)
+        return
+    # 形式が違うファイルは無いものとして扱う
+    if not is_valid_snapshot(saved):
+        app.logger.warning('保存済みの地震情報の形式が正しくありません: %s', SNAPSHOT_PATH)
+        return
+    set_snapshot(saved['data'], saved['fetched_at'])
+
+def refresh_snapshot():
+    global _last_failure
+    try:
+        earthquakes = fetch_earthquakes()
+    except Exception as e:
+        _last_failure = {'at': time.monotonic(), 'error': str(e)}
+        raise
+    _last_failure = None
+    fetched_at = time.time()
+    set_snapshot(earthquakes, fetched_at)
+    try:
+        save_snapshot(earthquakes, fetched_at)
+    except OSError as e:
+        app.logger.warning('地震情報を保存できませんでした: %s', e)
+
+def refresh_in_background():
+    # 既に更新中なら何もしない
+    if not _refresh_lock.acquire(blocking=False):
+        return
+    
+    def run():
+        try:
+            refresh_snapshot()
+        except Exception as e:
+            app.logger.warning('地震情報の更新に失敗しました: %s', e)
+        finally:
+            _refresh_lock.release()
+    
+    threading.Thread(target=run, daemon=True).start()
+
+def get_snapshot():
+    if not is_fresh(snapshot_age(), SNAPSHOT_MAX_AGE):
+        # 返せるものが無い、または古すぎるときは取得を待つ。
+        # 既に取得中ならその結果を待ち、自分では取得しない
+        with _refresh_lock:
+            if not is_fresh(snapshot_age(), SNAPSHOT_MAX_AGE):
+                # 直前の取得が失敗していれば、並んで取得し直さずにその結果を返す
+                failure = _last_failure
+                if failure is not None and time.monotonic() - failure['at'] < FETCH_RETRY_INTERVAL:
+                    raise RuntimeError(failure['error'])
+                refresh_snapshot()
+    elif not is_fresh(snapshot_age(), SNAPSHOT_TTL):
+        # 少し古い情報を返しつつ裏で更新する
+        refresh_in_background()
+    with _snapshot_lock:
+        return dict(_snapshot)
+
+def refresh_if_stale():
+    if not is_fresh(snapshot_age(), SNAPSHOT_TTL):
+        refresh_in_background()
+
+def warm_up():
+    # 起動時は保存済みの地震情報を読み込むだけにする。
+    # upstream からの取得は最初のレスポンスを返した後に行うので、
+    # debug のリローダーの親プロセスが取得や保存をすることもない
+    load_snapshot()
+
+def parse_fields(value):
+    if not value:
+        return None
+    requested = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = requested.difference(EARTHQUAKE_FIELDS)
+    if unknown:
+        raise ValueError('不明な項目です: ' + ', '.join(sorted(unknown)))
+    # 指定順に関係なく同じキャッシュを使えるように並びを揃える
+    return tuple(name for name in EARTHQUAKE_FIELDS if name in requested)
+
+def parse_limit(value):
+    if value is None:
+        return MAX_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('limit は整数で指定してください')
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError('limit は 1〜%d で指定してください' % MAX_LIMIT)
+    return limit
+
+def negotiate_encoding(accept_encodings):
+    # identity が明示されていればその q 値より高い方式だけを選ぶ
+    best, best_quality = 'identity', 0
+    if 'identity' in accept_encodings:
+        best_quality = accept_encodings['identity']
+    for encoding in COMPRESSORS:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def encode_earthquakes(snapshot, fields, limit, encoding):
+    key = (snapshot['version'], fields, limit, encoding)
+    with _snapshot_lock:
+        body = _response_cache.get(key)
+        if body is not None:
+            _response_cache.move_to_end(key)
+            return body
+    
+    if encoding == 'identity':
+        earthquakes = snapshot['data'][:limit]
+        if fields:
+            earthquakes = [{name: eq[name] for name in fields} for eq in earthquakes]
+        fetched_at = datetime.fromtimestamp(snapshot['fetched_at'], timezone.utc).isoformat()
+        # jsonify と同じく余分な空白を入れない
+        body = app.json.dumps({'success': True, 'fetchedAt': fetched_at, 'data': earthquakes},
+                              separators=(',', ':')).encode('utf-8')
+    else:
+        body = COMPRESSORS[encoding](encode_earthquakes(snapshot, fields, limit, 'identity'))
+    
+    with _snapshot_lock:
+        # 作っている間にスナップショットが更新されていたら保存しない
+        if key[0] == _snapshot['version']:
+            _response_cache[key] = body
+            while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)
+    return body
+
 @app.route('/api/earthquakes')
 def get_earthquakes():
     try:
-        response = requests.get(EARTHQUAKE_API, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        earthquakes = []
-        for item in data:
-            if item.get('code') == 551:  # 地震情報
-                eq_data = item.get('earthquake', {})
-                earthquakes.append({
-                    'id': item.get('id'),
-                    'time': eq_data.get('time'),
-                    'hypocenter': eq_data.get('hypocenter', {}).get('name', '不明'),
-                    'magnitude': eq_data.get('hypocenter', {}).get('magnitude', 0),
-                    'depth': eq_data.get('hypocenter', {}).get('depth', 0),
-                    'maxScale': eq_data.get('maxScale', 0),
-                    'domesticTsunami': eq_data.get('domesticTsunami', 'Unknown')
-                })
-        
-        return jsonify({'success': True, 'data': earthquakes})
+        fields = parse_fields(request.args.get('fields'))
+        limit = parse_limit(request.args.get('limit'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    try:
+        snapshot = get_snapshot()
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
+    
+    body = encode_earthquakes(snapshot, fields, limit, 'identity')
+    encoding = 'identity'
+    if len(body) >= COMPRESS_MIN_SIZE:
+        encoding = negotiate_encoding(request.accept_encodings)
+        if encoding != 'identity':
+            body = encode_earthquakes(snapshot, fields, limit, encoding)
+    
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({
+        'status': 'ok',
+        'uptime': time.monotonic() - PROCESS_STARTED_AT,
+        'firstResponseSeconds': _first_response_seconds,
+        'snapshotAge': snapshot_age()
+    })
+
+@app.route('/readyz')
+def readyz():
+    age = snapshot_age()
+    ready = is_fresh(age, SNAPSHOT_MAX_AGE)
+    return jsonify({
+        'ready': ready,
+        'snapshotAge': age,
+        'refreshing': _refresh_lock.locked()
+    }), 200 if ready else 503
+
+@app.after_request
+def record_first_response(response):
+    global _first_response_seconds, _refresh_scheduled
+    if not _refresh_scheduled:
+        _refresh_scheduled = True
+        response.call_on_close(refresh_if_stale)
+    if _first_response_seconds is None and request.path not in PROBE_PATHS:
+        _first_response_seconds = time.monotonic() - PROCESS_STARTED_AT
+        app.logger.info('起動から最初のレスポンスまで %.3f 秒', _first_response_seconds)
+    return response
 
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -335,5 +640,7 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+warm_up()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)